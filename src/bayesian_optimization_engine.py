@@ -10,14 +10,408 @@ The Bayesian Optimization implementation.
 """
 
 import logging
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
 
 import docker_monitor
 
-from bayes_opt import BayesianOptimization
+from bayes_opt import BayesianOptimization, UtilityFunction
+from bayes_opt.event import DEFAULT_EVENTS, Events
+from bayes_opt.logger import ScreenLogger
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+from scipy.optimize import minimize
+from scipy.stats import norm, qmc
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+
+try:
+    import numexpr
+except ImportError:  # optional, cost() falls back to plain NumPy
+    numexpr = None  # pylint: disable=invalid-name
 
 
 log = logging.getLogger('bayesian_opt_engine')  # pylint: disable=invalid-name
 
+# cost() as a single expression, so that numexpr evaluates it in one pass
+# without intermediate arrays. numexpr has no floor division, so the RAM units
+# are computed as (ram - ram % ram_unit) / ram_unit, the same for the
+# (non negative) RAM amounts.
+_COST_EXPRESSION = (
+    'where(t < 0, inf, '
+    '(cpu * (1 + ceps * 0.01) * cpu_coeff'
+    ' + (ram * (1 + reps * 0.01) - (ram * (1 + reps * 0.01)) % ram_unit)'
+    ' / ram_unit * ram_price) * t)'
+)
+
+
+def acquisition(mean, std, y_max, utility_function):
+    """Evaluate the acquisition function from the posterior mean and std.
+
+    Same formulas as bayes_opt.util.UtilityFunction, but working on an
+    already computed posterior, so that it can be fed from cached values.
+    """
+    if utility_function.kind == 'ucb':
+        return mean + utility_function.kappa * std
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        improvement = mean - y_max - utility_function.xi
+        z = improvement / std
+        if utility_function.kind == 'ei':
+            return improvement * norm.cdf(z) + std * norm.pdf(z)
+        return norm.cdf(z)
+###############################################################################
+
+
+def scale_to_bounds(sample, bounds):
+    """Map points of the unit box to the box given by bounds.
+
+    Unlike scipy.stats.qmc.scale, zero width dimensions (lower bound equal to
+    upper bound) are allowed.
+    """
+    return bounds[:, 0] + sample * (bounds[:, 1] - bounds[:, 0])
+###############################################################################
+
+
+def log_positive_acquisition(values, utility_function):
+    """Log of a strictly positive transform of the acquisition values.
+
+    Local penalization multiplies the acquisition function with penalties,
+    which only makes sense for a positive function. UCB is made positive with
+    a softplus, whose log tends to x for very negative x. EI and POI are
+    already non negative.
+    """
+    with np.errstate(divide='ignore', over='ignore'):
+        if utility_function.kind == 'ucb':
+            return np.where(values < -30.0, values,
+                            np.log(np.logaddexp(0.0, values)))
+        return np.log(np.clip(values, 1e-300, None))
+###############################################################################
+
+
+class CachedGaussianProcessRegressor(GaussianProcessRegressor):
+    """Gaussian process prior that keeps its Cholesky factor across fits.
+
+    The BO loop refits the prior on every iteration, although each iteration
+    only appends a new observation to the training set. When the new training
+    set extends the previous one, the cached factor L of K_XX + alpha * I is
+    extended with a block update instead of being refactorized from scratch.
+    Kernel hyperparameters are only re-optimized every refit_every fits, as
+    any change to them invalidates the cached factor.
+
+    predict() is inherited as is, since it already only uses L_ and alpha_.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, kernel=None, *, alpha=1e-10,
+                 optimizer='fmin_l_bfgs_b', n_restarts_optimizer=0,
+                 normalize_y=False, copy_X_train=True, random_state=None,
+                 refit_every=5):
+        """Initialization function"""
+        super().__init__(
+            kernel=kernel,
+            alpha=alpha,
+            optimizer=optimizer,
+            n_restarts_optimizer=n_restarts_optimizer,
+            normalize_y=normalize_y,
+            copy_X_train=copy_X_train,
+            random_state=random_state
+        )
+        self.refit_every = refit_every
+        self._fit_count = 0
+        self._y_fit = None
+        self._X_disc = None  # pylint: disable=invalid-name
+        self._K_disc = None  # pylint: disable=invalid-name
+        self._V_disc = None  # pylint: disable=invalid-name
+        self._disc_prior_var = None
+    ###########################################################################
+
+    def fit(self, X, y):  # pylint: disable=invalid-name
+        """Fit the prior, reusing the cached Cholesky factor if possible."""
+        X = np.asarray(X, dtype=np.float64)  # pylint: disable=invalid-name
+        y = np.asarray(y, dtype=np.float64)
+
+        # nothing new was observed, e.g. while filling several parallel slots
+        if (self._y_fit is not None and np.array_equal(X, self.X_train_) and
+                np.array_equal(y, self._y_fit)):
+            return self
+
+        self._fit_count += 1
+
+        if self._can_extend(X, y):
+            try:
+                self._extend(X, y)
+                self._y_fit = np.copy(y)
+                return self
+            except np.linalg.LinAlgError:
+                log.debug("Block Cholesky update failed, refactorizing")
+
+        super().fit(X, y)
+        self._cache_discretization()
+        self._y_fit = np.copy(y)
+        return self
+    ###########################################################################
+
+    def set_discretization(self, X_disc):  # pylint: disable=invalid-name
+        """Set the fixed points whose cross-covariances with the training set
+        are cached between fits, see predict_at_disc()."""
+        self._X_disc = np.asarray(X_disc, dtype=np.float64)
+        if hasattr(self, 'L_'):
+            self._cache_discretization()
+    ###########################################################################
+
+    def _cache_discretization(self):
+        """Compute the train/discretization cross-covariances from scratch."""
+        if self._X_disc is None:
+            return
+
+        self._K_disc = self.kernel_(self.X_train_, self._X_disc)
+        self._V_disc = solve_triangular(self.L_, self._K_disc, lower=True)
+        self._disc_prior_var = self.kernel_.diag(self._X_disc)
+    ###########################################################################
+
+    def predict_at_disc(self, return_std=False):
+        """Predict at the discretization points, using only the cached
+        cross-covariances, without any kernel evaluation."""
+        mean = self._K_disc.T @ self.alpha_
+        mean = self._y_train_std * mean + self._y_train_mean
+        if not return_std:
+            return mean
+
+        var = self._disc_prior_var - np.einsum('ij,ij->j', self._V_disc,
+                                               self._V_disc)
+        std = np.sqrt(np.clip(var, 0.0, None)) * self._y_train_std
+        return mean, std
+    ###########################################################################
+
+    def _can_extend(self, X, y):  # pylint: disable=invalid-name
+        """Check if X, y only append new observations to the cached ones."""
+        if not hasattr(self, 'L_') or self._fit_count % self.refit_every == 0:
+            return False
+        if np.ndim(self.alpha) != 0 or y.ndim != 1:
+            return False
+
+        n_old = self.X_train_.shape[0]
+        return (X.shape[0] > n_old and
+                np.array_equal(X[:n_old], self.X_train_))
+    ###########################################################################
+
+    def _extend(self, X, y):  # pylint: disable=invalid-name
+        """Extend the cached factor L with the appended rows of X.
+
+        With K = [[K_oo, K_on], [K_no, K_nn]] and K_oo = L L^T, the new factor
+        is [[L, 0], [L21, L22]] where L21 = (L^-1 K_on)^T and
+        L22 = cholesky(K_nn - L21 L21^T).
+        """
+        n_old = self.X_train_.shape[0]
+        X_new = X[n_old:]  # pylint: disable=invalid-name
+
+        k_on = self.kernel_(self.X_train_, X_new)
+        k_nn = self.kernel_(X_new) + self.alpha * np.eye(X_new.shape[0])
+
+        l21 = solve_triangular(self.L_, k_on, lower=True).T
+        l22 = cholesky(k_nn - l21 @ l21.T, lower=True)
+
+        if self._X_disc is not None:
+            k_new_disc = self.kernel_(X_new, self._X_disc)
+            v_new_disc = solve_triangular(
+                l22, k_new_disc - l21 @ self._V_disc, lower=True)
+            self._K_disc = np.vstack((self._K_disc, k_new_disc))
+            self._V_disc = np.vstack((self._V_disc, v_new_disc))
+
+        self.L_ = np.block([
+            [self.L_, np.zeros((n_old, X_new.shape[0]))],
+            [l21, l22]
+        ])
+
+        if self.normalize_y:
+            self._y_train_mean = np.mean(y)
+            self._y_train_std = np.std(y) or 1.0
+        else:
+            self._y_train_mean = 0.0
+            self._y_train_std = 1.0
+        y = (y - self._y_train_mean) / self._y_train_std
+
+        self.X_train_ = np.copy(X) if self.copy_X_train else X
+        self.y_train_ = y
+        self.alpha_ = cho_solve((self.L_, True), y, check_finite=False)
+        self.log_marginal_likelihood_value_ = (
+            -0.5 * y @ self.alpha_
+            - np.log(np.diag(self.L_)).sum()
+            - 0.5 * y.shape[0] * np.log(2 * np.pi)
+        )
+        # older scikit-learn versions lazily cache K^-1 for predict()
+        self._K_inv = None  # pylint: disable=invalid-name
+
+        return self
+    ###########################################################################
+###############################################################################
+
+
+class CachedBayesianOptimization(BayesianOptimization):
+    """BayesianOptimization with a cached prior and a batched acquisition search.
+
+    The search space is discretized once with a Sobol sequence, whose
+    posterior comes from the prior's cached cross-covariances. Each iteration
+    also scores a fresh Latin hypercube sample of candidates with a single
+    vectorized predict() call. L-BFGS is then only run from the few best
+    scored points, instead of the library's random multistart.
+    """
+
+    DISCRETIZATION_POINTS = 4096
+    CANDIDATE_POINTS = 10000
+    REFINED_CANDIDATES = 5
+
+    def __init__(self, f, pbounds, **kwargs):
+        """Initialization function"""
+        super().__init__(f=f, pbounds=pbounds, **kwargs)
+
+        # same prior as the library default, with a cached Cholesky factor
+        self._gp = CachedGaussianProcessRegressor(
+            kernel=Matern(nu=2.5),
+            alpha=1e-6,
+            normalize_y=True,
+            n_restarts_optimizer=5,
+            random_state=self._random_state
+        )
+
+        bounds = self._space.bounds
+        sobol = qmc.Sobol(d=bounds.shape[0],
+                          seed=self._random_state.randint(2**31))
+        self._discretization = scale_to_bounds(
+            sobol.random(self.DISCRETIZATION_POINTS), bounds)
+        self._gp.set_discretization(self._discretization)
+    ###########################################################################
+
+    def suggest(self, utility_function, pending=()):
+        """Most promising point to probe next.
+
+        pending are the params of points already being probed, whose
+        neighbourhood is penalized so that a batch of different points can be
+        suggested.
+        """
+        if len(self._space) == 0:
+            return self._space.array_to_params(self._space.random_sample())
+
+        # Sklearn's GP throws a large number of warnings at times, but
+        # we don't really need to see them here.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self._gp.fit(self._space.params, self._space.target)
+
+        return self._space.array_to_params(
+            self._acq_max(utility_function, pending))
+    ###########################################################################
+
+    def _acq_max(self, utility_function, pending):
+        """Find the maximum of the acquisition function.
+
+        Score the discretization and a batch of random candidates at once,
+        then refine the REFINED_CANDIDATES best of them with L-BFGS.
+        """
+        y_max = self._space.target.max()
+        bounds = self._space.bounds
+        penalize = self._local_penalization(pending, y_max, utility_function)
+
+        lhs = qmc.LatinHypercube(d=bounds.shape[0],
+                                 seed=self._random_state.randint(2**31))
+        candidates = scale_to_bounds(lhs.random(self.CANDIDATE_POINTS),
+                                     bounds)
+
+        disc_mean, disc_std = self._gp.predict_at_disc(return_std=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            cand_mean, cand_std = self._gp.predict(candidates,
+                                                   return_std=True)
+
+        x_tries = np.vstack((self._discretization, candidates))
+        scores = penalize(x_tries, acquisition(
+            np.concatenate((disc_mean, cand_mean)),
+            np.concatenate((disc_std, cand_std)),
+            y_max, utility_function
+        ))
+
+        best = np.argpartition(scores, -self.REFINED_CANDIDATES)[
+            -self.REFINED_CANDIDATES:]
+        x_max = x_tries[scores.argmax()]
+        max_acq = scores.max()
+
+        def to_minimize(x):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                mean, std = self._gp.predict(x.reshape(1, -1),
+                                             return_std=True)
+            return -penalize(x.reshape(1, -1), acquisition(
+                mean, std, y_max, utility_function))[0]
+
+        for x_try in x_tries[best]:
+            res = minimize(to_minimize, x_try, bounds=bounds,
+                           method='L-BFGS-B')
+            if res.success and -res.fun >= max_acq:
+                x_max = res.x
+                max_acq = -res.fun
+
+        # Clip output to make sure it lies within the bounds. Due to floating
+        # point technicalities this is not always the case.
+        return np.clip(x_max, bounds[:, 0], bounds[:, 1])
+    ###########################################################################
+
+    def _local_penalization(self, pending, y_max, utility_function):
+        """Return a function penalizing acquisition values near pending points.
+
+        Follows the local penalization of Gonzalez et al. (2016): a pending
+        point x_j most likely excludes a ball around it, whose radius depends
+        on its posterior and on a Lipschitz constant L of the objective. The
+        returned function gives the log of the penalized acquisition values.
+        """
+        if not pending:
+            return lambda x, scores: scores
+
+        bounds = self._space.bounds
+        width = bounds[:, 1] - bounds[:, 0]
+        # zero width dimensions do not contribute to the distances
+        scale = np.where(width > 0, width, 1.0)
+        pending = np.array([self._space.params_to_array(params)
+                            for params in pending])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mean, std = self._gp.predict(pending, return_std=True)
+        std = np.maximum(std, 1e-9)
+        lipschitz = self._lipschitz(width)
+
+        def penalize(x, scores):
+            dist = np.linalg.norm(
+                (x[:, np.newaxis, :] - pending[np.newaxis, :, :]) / scale,
+                axis=-1
+            )
+            z = (lipschitz * dist - y_max + mean) / std
+            return (log_positive_acquisition(scores, utility_function) +
+                    norm.logcdf(z).sum(axis=1))
+
+        return penalize
+    ###########################################################################
+
+    def _lipschitz(self, width):
+        """Estimate the Lipschitz constant of the posterior mean, in a search
+        space normalized to the unit box, by finite differences over the
+        discretization."""
+        step = 1e-4
+        mean = self._gp.predict_at_disc()
+        grads = np.zeros_like(self._discretization)
+        for dim in np.flatnonzero(width > 0):
+            shifted = self._discretization.copy()
+            shifted[:, dim] += step * width[dim]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                grads[:, dim] = (self._gp.predict(shifted) - mean) / step
+
+        lipschitz = np.linalg.norm(grads, axis=1).max()
+        # a flat posterior gives no information, fall back to a default
+        return lipschitz if lipschitz > 1e-7 else 10.0
+    ###########################################################################
+###############################################################################
+
 
 class BayesianOptimizationEngine:
     """Performs Bayesian optimization on black box computing cost functions."""
@@ -36,41 +430,75 @@ class BayesianOptimizationEngine:
         }
     }
 
-    def __init__(self, min_cpu, max_cpu, min_ram, max_ram, black_box_function):
-        """Initialization function"""
+    # pylint: disable=too-many-arguments
+    def __init__(self, min_cpu, max_cpu, min_ram, max_ram, black_box_function,
+                 parallel_trials=1, on_interrupt=None):
+        """Initialization function
+
+        on_interrupt is called if a parallel optimization is interrupted (e.g.
+        by Ctrl-C), to abort the black box functions still running, as their
+        threads cannot be interrupted.
+        """
         self.bounds = {
             'cpu': (min_cpu, max_cpu),
             'ram': (min_ram, max_ram)
         }
-        self.optimizer = BayesianOptimization(
+        self.black_box_function = black_box_function
+        self.parallel_trials = max(1, parallel_trials)
+        self.on_interrupt = on_interrupt
+        self.optimizer = CachedBayesianOptimization(
             f=black_box_function,
             pbounds=self.bounds
         )
+        screen_logger = ScreenLogger()
+        for event in DEFAULT_EVENTS:
+            self.optimizer.subscribe(event, screen_logger)
+
+        # cost constants, bound once instead of looked up on every cost() call
+        self._cpu_coeff = self.COSTS['CPU']['price'] / self.COSTS['CPU']['unit']
+        self._ram_unit = self.COSTS['RAM']['unit']
+        self._ram_price = self.COSTS['RAM']['price']
     ###########################################################################
 
     def cost(self, cpu_used, ram_used, total_time):
         """Measure the cost of an execution.
            The noise "epsilon" is also used, to emulate the functions of the
            paper.
-        """
-        # if for whatever reason the computation didn't succeed,
-        # set the cost as infinite
-        if total_time < 0:
-            return float('inf')
 
-        cpu_epsilon = docker_monitor.get_noise()
-        ram_epsilon = docker_monitor.get_noise()
+           Accepts either scalars or equally sized 1-D arrays, so that a whole
+           optimization trajectory can be priced in one shot. Scalar inputs
+           return a float, array inputs return an array.
+        """
+        cpu_used = np.asarray(cpu_used, dtype=np.float64)
+        ram_used = np.asarray(ram_used, dtype=np.float64)
+        total_time = np.asarray(total_time, dtype=np.float64)
 
-        actual_cpu = int(cpu_used + cpu_used * cpu_epsilon / 100.0)
-        actual_ram = int(ram_used + ram_used * ram_epsilon / 100.0)
+        cpu_epsilon, ram_epsilon = docker_monitor.get_noise_batch(
+            (2,) + cpu_used.shape)
 
-        effective_cpu = actual_cpu / self.COSTS['CPU']['unit']
-        effective_ram = int(actual_ram / self.COSTS['RAM']['unit'])
+        if numexpr is not None:
+            cost = numexpr.evaluate(_COST_EXPRESSION, local_dict={
+                'cpu': cpu_used, 'ceps': cpu_epsilon,
+                'ram': ram_used, 'reps': ram_epsilon,
+                't': total_time,
+                'cpu_coeff': self._cpu_coeff,
+                'ram_unit': self._ram_unit,
+                'ram_price': self._ram_price,
+                'inf': np.inf
+            })
+        else:
+            cpu_cost = cpu_used * (1 + cpu_epsilon * 0.01) * self._cpu_coeff
+            ram_cost = ((ram_used * (1 + ram_epsilon * 0.01)) // self._ram_unit
+                        * self._ram_price)
 
-        cpu_cost = effective_cpu * self.COSTS['CPU']['price']
-        ram_cost = effective_ram * self.COSTS['RAM']['price']
+            # if for whatever reason the computation didn't succeed,
+            # set the cost as infinite
+            cost = np.where(total_time < 0, np.inf,
+                            (cpu_cost + ram_cost) * total_time)
 
-        return (cpu_cost + ram_cost) * total_time
+        if cost.ndim == 0:
+            return float(cost)
+        return cost
     ###########################################################################
 
     def optimize(self, initialization_points, iterations):
@@ -81,13 +509,72 @@ class BayesianOptimizationEngine:
 
         Run iterations number steps of the bayesian optimization.
 
+        Up to parallel_trials points are probed concurrently. Every time one
+        finishes, its result is registered and a new point is suggested,
+        penalizing the neighbourhood of the ones still running.
+
         Return the best values found.
         """
-        self.optimizer.maximize(
-            init_points=initialization_points,
-            n_iter=iterations
-        )
+        # same acquisition function as the BayesianOptimization.maximize
+        # defaults
+        utility_function = UtilityFunction(kind='ucb', kappa=2.576, xi=0.0)
+        # True for a random exploration point, False for a suggested one
+        schedule = [True] * initialization_points + [False] * iterations
+
+        self.optimizer.dispatch(Events.OPTIMIZATION_START)
+        if self.parallel_trials == 1:
+            # run inline, so that an interrupt reaches the black box function
+            for explore in schedule:
+                params = self._next_params(utility_function, explore, ())
+                self.optimizer.register(
+                    params=params, target=self.black_box_function(**params))
+        else:
+            self._optimize_parallel(utility_function, schedule)
+        self.optimizer.dispatch(Events.OPTIMIZATION_END)
 
         return self.optimizer.max
     ###########################################################################
+
+    def _optimize_parallel(self, utility_function, schedule):
+        """Probe the scheduled points, up to parallel_trials at once"""
+        executor = ThreadPoolExecutor(max_workers=self.parallel_trials)
+        running = {}
+        try:
+            for explore in schedule:
+                params = self._next_params(utility_function, explore,
+                                           list(running.values()))
+                running[executor.submit(self.black_box_function,
+                                        **params)] = params
+                if len(running) == self.parallel_trials:
+                    # wait for a free slot
+                    self._register_completed(running)
+
+            while running:
+                self._register_completed(running)
+        except BaseException:
+            # do not wait for the running black box functions to complete
+            executor.shutdown(wait=False, cancel_futures=True)
+            if self.on_interrupt is not None:
+                self.on_interrupt()
+            raise
+        executor.shutdown()
+    ###########################################################################
+
+    def _register_completed(self, running):
+        """Wait for at least one running point and register its result"""
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            self.optimizer.register(params=running.pop(future),
+                                    target=future.result())
+    ###########################################################################
+
+    def _next_params(self, utility_function, explore, pending):
+        """Next point to probe, random if explore else suggested"""
+        if explore:
+            space = self.optimizer.space
+            return space.array_to_params(space.random_sample())
+
+        utility_function.update_params()
+        return self.optimizer.suggest(utility_function, pending=pending)
+    ###########################################################################
 ###############################################################################
@@ -14,8 +14,10 @@ library, for facilitating the control of the running workloads.
 """
 
 import logging
+import time
 
 import docker
+import requests
 
 log = logging.getLogger('docker_controller')  # pylint: disable=invalid-name
 
@@ -23,19 +25,47 @@ log = logging.getLogger('docker_controller')  # pylint: disable=invalid-name
 
 class DockerController:
     """Controls docker containers and images"""
+
+    # seconds for which a container status is reused before asking the daemon
+    STATUS_TTL = 0.2
+
     def __init__(self, docker_server=None):
         """Initialization function"""
         if docker_server:
             self.client = docker.DockerClient(base_url=docker_server)
         else:
             self.client = docker.from_env()
+
+        # container name -> (status, monotonic expiry time)
+        self._status_cache = {}
+        # 'name:version' -> resolved image
+        self._images = {}
+        # container name -> container, for the containers not yet removed
+        self._containers = {}
+    ###########################################################################
+
+    def pull(self, name, version):
+        """Resolve an image once, pulling it only if it is not present locally.
+
+        Containers started afterwards by run_container use the resolved image
+        directly.
+        """
+        tag = f'{name}:{version}'
+        try:
+            image = self.client.images.get(tag)
+        except docker.errors.ImageNotFound:
+            log.info("Image %s not found locally, pulling it", tag)
+            image = self.client.images.pull(name, tag=version)
+        self._images[tag] = image
+        return image
     ###########################################################################
 
     def run_container(self, name, version, cpu_limit, memory_limit,
                       sql_script):
         """run a container"""
-        return self.client.containers.run(
-            f'{name}:{version}',
+        tag = f'{name}:{version}'
+        container = self.client.containers.run(
+            self._images.get(tag, tag),
             mem_limit=memory_limit,
             nano_cpus=cpu_limit,
             volumes= {
@@ -49,12 +79,28 @@ class DockerController:
             stderr=True
         )
         # nano_cpus=2 * 10**9 for 2 CPUs
+        self._containers[container.name] = container
+        return container
+    ###########################################################################
+
+    def status(self, name):
+        """get the status of a container, cached for STATUS_TTL seconds"""
+        now = time.monotonic()
+        cached = self._status_cache.get(name)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        # containers.get() inspects the container, so unlike the status of an
+        # already held Container object, this one is never stale
+        status = self.client.containers.get(name).status
+        self._status_cache[name] = (status, now + self.STATUS_TTL)
+        return status
     ###########################################################################
 
     def still_running(self, name):
         """check if a container is still running"""
-        container = self.client.containers.get(name)
-        return container.status.upper() == 'RUNNING'
+        # the daemon reports lowercase states: created, running, exited...
+        return self.status(name) == 'running'
     ###########################################################################
 
     def not_running(self, name):
@@ -62,14 +108,64 @@ class DockerController:
         return not self.still_running(name)
     ###########################################################################
 
+    def wait_for_exit(self, name, timeout):
+        """Block until a container exits or timeout seconds pass.
+
+        Returns True if the container exited, False on timeout.
+        """
+        # requests rejects a zero timeout, there is nothing to wait for anyway
+        if timeout <= 0:
+            return self.not_running(name)
+
+        try:
+            self.client.api.wait(name, timeout=timeout)
+        except (requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError):
+            return False
+
+        self._status_cache[name] = ('exited',
+                                    time.monotonic() + self.STATUS_TTL)
+        return True
+    ###########################################################################
+
     def container_exit_code(self, name):
         """check if a container exited successfully"""
         if self.still_running(name):
             return None
 
-        container = self.client.containers.get(name)
-        result = container.wait()
+        result = self.client.api.wait(name)
         print(result)
         return result['StatusCode']
     ###########################################################################
+
+    def stop_container(self, container):
+        """stop a container"""
+        container.stop()
+        self._status_cache.pop(container.name, None)
+    ###########################################################################
+
+    def kill_container(self, container):
+        """kill a container"""
+        container.kill()
+        self._status_cache.pop(container.name, None)
+    ###########################################################################
+
+    def remove_container(self, container):
+        """remove a container"""
+        container.remove()
+        self._status_cache.pop(container.name, None)
+        self._containers.pop(container.name, None)
+    ###########################################################################
+
+    def kill_all(self):
+        """kill all the containers started and not yet removed, e.g. to abort
+        the experiments still running on an interrupt"""
+        for container in list(self._containers.values()):
+            try:
+                if self.still_running(container.name):
+                    self.kill_container(container)
+            except docker.errors.APIError as exc:
+                log.error("Couldn't kill container %s due to %s",
+                          container.name, exc)
+    ###########################################################################
 ###############################################################################
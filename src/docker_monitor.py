@@ -11,11 +11,14 @@ Gaussian distribution with mean 0 and variance 1 is returned.
 """
 
 import logging
-import random
+
+import numpy as np
 
 
 log = logging.getLogger('docker_monitor')  # pylint: disable=invalid-name
 
+_rng = np.random.default_rng()  # pylint: disable=invalid-name
+
 
 def get_noise():
     """Get the observed noise from a cloud environment, by emulating well known
@@ -24,7 +27,17 @@ def get_noise():
     In reality, just return a value from the normal distrubution N(0,100). See
     the top of this file for more information.
     """
-    noise = random.gauss(mu=0.0, sigma=10.0)
-    log.info("Generated noise: %s", noise)
+    return get_noise_batch(1)[0]
+###############################################################################
+
+
+def get_noise_batch(n=1):
+    """Same as get_noise, but return n noise values at once.
+
+    n can also be a shape tuple, as in numpy.
+    """
+    noise = _rng.normal(0.0, 10.0, size=n)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Generated noise: %s", noise)
     return noise
 ###############################################################################
@@ -2,31 +2,68 @@
 # -*- coding: utf-8 -*-
 
 """
-Orchestrates the container resource configuration selection process. Users
-supply a representative workload (udf+data in our case) and its constraints
-(budget, max running time, min/max CPU/RAM, etc)). Based on these inputs, the
-search controller obtains a list of candidate container configurations and
-passes it to the BO engine.
+Command line interface of the search controller, see search_lib for the
+search itself.
 
-This is the main entrypoint to the application. Sets up the workloads via the
-Docker Controller, creates and runs the container and monitors the Bayesian
-Optimization Engine to steer and store the result of the search.
+This is the main entrypoint to the application. Parses and validates the
+user supplied constraints and runs the search with them.
 """
 
 import argparse
-import logging
 import multiprocessing
 import os
-import random
 import sys
-import time
 
-import docker
+import search_lib
+from search_lib import bytes2human
 
-import docker_controller
-import bayesian_optimization_engine
+log = search_lib.log
+
+def _memory_fits(args, limits):
+    """Check the memory limit against what we actually have, minus an
+    arbitrary ~100MB. Only warn if the available memory is not known."""
+    if limits['allowed_memory'] is None:
+        print("Could not detect available memory. If you ask too much, the "
+              "system might hang or the OOM killer engaged.", file=sys.stderr)
+        return True
+    return args.memory_limit <= limits['allowed_memory']
+###############################################################################
+
+
+# (predicate on the parsed arguments and the host limits, error message
+# builder), checked in order
+_VALIDATORS = (
+    # negative values not allowed
+    (lambda args, limits: min(
+        args.cpu_limit, args.time_limit, args.memory_limit) >= 0,
+     lambda args, limits: "Negative parameters not allowed."),
+    # path provided must be valid file
+    (lambda args, limits: os.path.isfile(args.sql_script),
+     lambda args, limits: f"Bad command or file name: {args.sql_script}"),
+    # limit CPUs to what we actually have
+    (lambda args, limits: args.cpu_limit <= limits['max_cpu'],
+     lambda args, limits: f"A maximum of {limits['max_cpu']} CPUs are "
+                          "allowed."),
+    # limit memory to what we actually have
+    (_memory_fits,
+     lambda args, limits: f"A maximum of "
+                          f"{bytes2human(limits['allowed_memory'])} of RAM "
+                          "are allowed."),
+    # arbitrary limit of container maximum runtime to one hour
+    (lambda args, limits: args.time_limit <= 3600,
+     lambda args, limits: "A maximum of one hour is allowed for container "
+                          "time limit."),
+    # sanity check for iterations
+    (lambda args, limits: 1 <= args.iterations <= 100,
+     lambda args, limits: "Iterations must be between 1 and 100"),
+    # concurrent experiments must fit in the host
+    (lambda args, limits: (
+        1 <= args.parallel_trials <= limits['max_parallel_trials']),
+     lambda args, limits: "Parallel trials must be between 1 and "
+                          f"{limits['max_parallel_trials']} for the given "
+                          "limits on this host."),
+)
 
-log = logging.getLogger('search_controller')
 
 def parse_args(available_memory):
     """Argument parsing function"""
@@ -71,6 +108,15 @@ def parse_args(available_memory):
              "steps the more likely to find a good minimum. Optional. Default "
              "value is 5."
     )
+    parser.add_argument(
+        '-p', '--parallel_trials',
+        type=int,
+        required=False,
+        default=1,
+        help="The number of experiments to run concurrently. Concurrent "
+             "experiments compete for the host resources, which may skew "
+             "their measured execution time. Optional. Default value is 1."
+    )
     parser.add_argument(
         '-d', '--debug',
         required=False,
@@ -81,45 +127,18 @@ def parse_args(available_memory):
 
     args = parser.parse_args()
 
-    # negative values not allowed
-    if any(x<0 for x in [args.cpu_limit, args.time_limit, args.memory_limit]):
-        print("Negative parameters not allowed.", file=sys.stderr)
-        sys.exit(1)
-
-    # path provided must be valid file
-    if not os.path.isfile(args.sql_script):
-        print(f"Bad command or file name: {args.sql_script}", file=sys.stderr)
-        sys.exit(1)
-
-    # limit CPUs to what we actually have
-    max_cpu = multiprocessing.cpu_count()
-    if args.cpu_limit > max_cpu:
-        print(f"A maximum of {max_cpu} CPUs are allowed.",
-              file=sys.stderr)
-        sys.exit(1)
-
-    # limit memory to what we actually have minus an arbitrary ~100MB
-    if available_memory < 0:
-        print("Could not detect available memory. If you ask too much, the "
-              "system might hang or the OOM killer engaged.", file=sys.stderr)
-    else:
-        allowed_memory = available_memory - 100 * 1024**2
-        if args.memory_limit > allowed_memory:
-            print(f"A maximum of {bytes2human(allowed_memory)} of RAM are "
-                  "allowed.", file=sys.stderr)
+    limits = {
+        'max_cpu': multiprocessing.cpu_count(),
+        'max_parallel_trials': search_lib.max_parallel_trials(
+            args.cpu_limit, args.memory_limit, available_memory),
+        'allowed_memory': (available_memory - search_lib.RESERVED_MEMORY
+                           if available_memory >= 0 else None)
+    }
+    for is_valid, message in _VALIDATORS:
+        if not is_valid(args, limits):
+            print(message(args, limits), file=sys.stderr)
             sys.exit(1)
 
-    # arbitrary limit of container maximum runtime to one hour
-    if args.time_limit > 3600:
-        print("A maximum of one hour is allowed for container time limit.",
-              file=sys.stderr)
-        sys.exit(1)
-
-    # sanity check for iterations
-    if not 1 <= args.iterations <= 100:
-        print("Iterations must be between 1 and 100", file=sys.stderr)
-        sys.exit(1)
-
     # convert to absolute path, as it is required by docker to be moutned
     args.sql_script = os.path.abspath(args.sql_script)
 
@@ -127,218 +146,22 @@ def parse_args(available_memory):
 ###############################################################################
 
 
-def setup_logging(verbose=False):
-    """Setup logging"""
-    loglevel = logging.NOTSET
-    if verbose is False:
-        loglevel = logging.INFO
-    elif verbose is True:
-        loglevel = logging.DEBUG
-
-    log_fmt = '%(asctime)s -- %(name)s -- %(levelname)s -- %(message)s'
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(loglevel)
-    formatter = logging.Formatter(log_fmt)
-    stdout_handler.setFormatter(formatter)
-    log.addHandler(stdout_handler)
-    log.setLevel(loglevel)
-###############################################################################
-
-
-def run_until(condition_function, timeout, *args):
-    """Run a function until the condition_functionr returns true or timeout """
-    start = time.time()
-    while not condition_function(*args) and time.time() - start < timeout:
-        time.sleep(0.5)
-
-    if time.time() - start > timeout:
-        return False
-    return True
-###############################################################################
-
-
-def bytes2human(num):
-    """Convert int bytes to human readable format"""
-    for unit in ["", "K", "M", "G"]:
-        if abs(num) < 1024:
-            return f"{num:3.1f}{unit}B"
-        num /= 1024.0
-    return "\_(o_o)_/ ETOOMUCHRAM \_(o_o)_/"
-###############################################################################
-
-
-def cpuinfo():
-    """Get CPU info for the host"""
-    if sys.platform == "linux":
-        with open('/proc/cpuinfo', encoding='utf-8') as infile:
-            for line in infile:
-                if line.startswith('model name'):
-                    return line.split(':')[1].strip()
-    else:
-        print(f"Unsupported platform: {sys.platform}. Exiting.",
-              file=sys.stderr)
-        sys.exit(2)
-
-    return 'not detected'
-###############################################################################
-
-
-def meminfo():
-    """Get RAM info for the host"""
-    total = -1
-    available = -1
-    if sys.platform == "linux":
-        with open('/proc/meminfo', encoding='utf-8') as infile:
-            for line in infile:
-                if line.startswith('MemTotal'):
-                    total = int(line.split()[1].strip()) * 1024
-                elif line.startswith('MemAvailable'):
-                    available = int(line.split()[1].strip()) * 1024
-    else:
-        print(f"Unsupported platform: {sys.platform}. Exiting.",
-              file=sys.stderr)
-        sys.exit(2)
-
-    if total > 0 and available > 0:
-        return (total, available)
-    return (-1, -1)
-###############################################################################
-
-
-def run_experiment(controller, cpu, ram, sql_script, max_time):
-    """The black box function we want to minimize.
-
-    We give it cpu and ram (our only resources) and it calculates time to run
-    to completion.
-
-    Note: return negative, as the underlying library only supports maximization
-    (so essentially we do minimization).
-    """
-
-    # accomodate for the underlying library using only full float numbers
-    cpu = round(cpu, 2)
-    ram = int(ram)
-
-    log.info("Attempting to start container")
-    container = controller.run_container(
-        'sourcherrypick', 'latest',
-        int(cpu * 10**9),
-        ram,
-        sql_script
-    )
-    log.info("Container started")
-
-    try:
-        # run container until completion or time out
-        log.info(
-            "Running container with CPU limit: %s, RAM limit: %s, SQL script: "
-            "%s, until it completes or %s seconds pass.", cpu,
-            bytes2human(ram), sql_script, max_time
-        )
-
-        start = time.time()
-
-        in_time = run_until(
-            controller.not_running,
-            max_time,
-            container.name
-        )
-
-
-        # return a special, random "too big" value
-        # needs to be random, else the BO process cannot properly explore the
-        # search space
-        if not in_time:
-            total_time = (max_time + random.randint(0,1000)) * -2
-
-            try:
-                container.kill()
-            except docker.errors.APIError as exc:
-                log.error("Couldn't kill container %s due to %s. Please "
-                          "manually verify if it is still running after "
-                          "execution completes.", container.name, exc)
-            log.warning("Execution timed out")
-        else:
-            exit_code = controller.container_exit_code(container.name)
-            if exit_code == 0:
-                total_time = time.time() - start
-                log.info("Container execution finished on time")
-            else:
-                # return a special, random "too big" value
-                # needs to be random, else the BO process cannot properly
-                # explore the search space
-                total_time = (max_time + random.randint(0,1000)) * -2
-                log.info("Container execution finished unsuccessfully")
-
-        log.info("Execution logs follow\n")
-        logs = container.logs(timestamps=True)
-        for item in logs.decode('utf-8').split('\n'):
-            print(f"    {item}")
-    finally:
-        log.info("Performing pre-exit cleanup")
-        if controller.still_running(container.name):
-            container.stop()
-        container.remove()
-        log.info("Pre-exit cleanup completed")
-
-    if total_time < 0:
-        return total_time
-    return total_time * -1
-###############################################################################
-
-
 def main():
     """main function"""
-    cpu_info = cpuinfo()
-    total_ram, available_ram = meminfo()
+    _, available_ram = search_lib.meminfo()
 
     args = parse_args(available_ram)
-    setup_logging(args.debug)
-
-    log.info("Initializing...")
-    log.info("Detected CPU: %s", cpu_info)
-    log.info("Total / Available Memory: %s / %s", bytes2human(total_ram),
-             bytes2human(available_ram))
-
-    vm_controller = docker_controller.DockerController()
-    log.info("Connection to docker daemon established")
-
-    bayes_optimizer = bayesian_optimization_engine.BayesianOptimizationEngine(
-        min_cpu=min(args.cpu_limit, 0.1),             # 10 percent of one cpu
-        max_cpu=args.cpu_limit,
-        min_ram=min(args.memory_limit, 60*10**6),     # 60 MB of RAM
-        max_ram=args.memory_limit,
-        black_box_function = lambda cpu, ram: run_experiment(
-            vm_controller, cpu, ram,args.sql_script, args.time_limit)
-    )
-
-    log.info("Starting bayes optimization")
-    start = time.time()
-
-    bayes_optimizer.optimize(
-        initialization_points=3,    # same value as the paper (using the same kernel function, Matern)
-        iterations=args.iterations
+    search_lib.setup_logging(args.debug)
+
+    search_lib.run(
+        args.cpu_limit,
+        args.memory_limit,
+        args.time_limit,
+        args.sql_script,
+        args.iterations,
+        args.parallel_trials
     )
 
-    log.info("Finished bayes optimization after %s secs", time.time() - start)
-    log.info("Best values: CPU: %.2f RAM: %s execution time: %.2f cost: %.3f",
-        bayes_optimizer.optimizer.max['params']['cpu'],
-        bytes2human(int(bayes_optimizer.optimizer.max['params']['ram'])),
-        bayes_optimizer.optimizer.max['target']*-1,
-        bayes_optimizer.cost(bayes_optimizer.optimizer.max['params']['cpu'],
-        bayes_optimizer.optimizer.max['params']['ram'],
-        bayes_optimizer.optimizer.max['target']*-1
-    ))
-    if bayes_optimizer.optimizer.max['target'] <= args.time_limit*-2:
-        log.warning("No valid parameters found due to the given constraints.")
-
-    log.info("Full bayesian optimization log:")
-    for i, item in enumerate(bayes_optimizer.optimizer.res):
-        log.info("Iteration %s: cpu %.2f ram %s  exec time: %.2f", i,
-            item['params']['cpu'],
-            bytes2human(int(item['params']['ram'])),
-            item['target']*-1)
-
     log.info("Exiting successfully")
 ###############################################################################
 
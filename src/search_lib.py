@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Orchestrates the container resource configuration selection process. Users
+supply a representative workload (udf+data in our case) and its constraints
+(budget, max running time, min/max CPU/RAM, etc)). Based on these inputs, the
+search controller obtains a list of candidate container configurations and
+passes it to the BO engine.
+
+This is the importable API of the search controller: run() sets up the
+workloads via the Docker Controller, creates and runs the containers and
+monitors the Bayesian Optimization Engine to steer and store the result of the
+search. The docker and bayes_opt dependencies are only imported once they are
+first needed, so that importing this module stays cheap.
+"""
+
+import logging
+import multiprocessing
+import random
+import re
+import sys
+import time
+
+log = logging.getLogger('search_controller')
+
+IMAGE_NAME = 'sourcherrypick'
+IMAGE_VERSION = 'latest'
+
+# RAM left to the host, never handed out to containers (~100MB, arbitrary)
+RESERVED_MEMORY = 100 * 1024**2
+
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+# /proc files are read whole and scanned once for the fields we need
+_CPUINFO_RE = re.compile(rb'^model name\s*:\s*(.+)$', re.M)
+_MEMINFO_RE = re.compile(
+    rb'^MemTotal:\s+(\d+).*?^MemAvailable:\s+(\d+)', re.M | re.S)
+
+
+def setup_logging(verbose=False):
+    """Setup logging"""
+    loglevel = logging.NOTSET
+    if verbose is False:
+        loglevel = logging.INFO
+    elif verbose is True:
+        loglevel = logging.DEBUG
+
+    log_fmt = '%(asctime)s -- %(name)s -- %(levelname)s -- %(message)s'
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setLevel(loglevel)
+    formatter = logging.Formatter(log_fmt)
+    stdout_handler.setFormatter(formatter)
+    log.addHandler(stdout_handler)
+    log.setLevel(loglevel)
+###############################################################################
+
+
+def bytes2human(num):
+    """Convert int bytes to human readable format"""
+    num = int(num)
+    if num == 0:
+        return '0.0B'
+    if num < 0:
+        return f"-{bytes2human(-num)}"
+    # each unit is 2**10 times the previous one
+    i = min((num.bit_length() - 1) // 10, len(_UNITS) - 1)
+    return f"{num / (1 << (10 * i)):3.1f}{_UNITS[i]}"
+###############################################################################
+
+
+class _HumanBytes:  # pylint: disable=too-few-public-methods
+    """Lazy bytes2human, for logging arguments.
+
+    logging only converts its arguments to str if the record is emitted, so
+    filtered out records skip the formatting entirely.
+    """
+    __slots__ = ('num',)
+
+    def __init__(self, num):
+        """Initialization function"""
+        self.num = num
+
+    def __str__(self):
+        return bytes2human(self.num)
+###############################################################################
+
+
+def cpuinfo():
+    """Get CPU info for the host"""
+    if sys.platform == "linux":
+        with open('/proc/cpuinfo', 'rb') as infile:
+            match = _CPUINFO_RE.search(infile.read())
+        if match:
+            return match[1].decode('utf-8').strip()
+    else:
+        print(f"Unsupported platform: {sys.platform}. Exiting.",
+              file=sys.stderr)
+        sys.exit(2)
+
+    return 'not detected'
+###############################################################################
+
+
+def meminfo():
+    """Get RAM info for the host"""
+    total = -1
+    available = -1
+    if sys.platform == "linux":
+        with open('/proc/meminfo', 'rb') as infile:
+            match = _MEMINFO_RE.search(infile.read())
+        if match:
+            total = int(match[1]) * 1024
+            available = int(match[2]) * 1024
+    else:
+        print(f"Unsupported platform: {sys.platform}. Exiting.",
+              file=sys.stderr)
+        sys.exit(2)
+
+    if total > 0 and available > 0:
+        return (total, available)
+    return (-1, -1)
+###############################################################################
+
+
+def max_parallel_trials(cpu_limit, memory_limit, available_memory):
+    """How many experiments can run at once, each with up to cpu_limit CPUs
+    and memory_limit bytes of RAM, without oversubscribing the host."""
+    trials = multiprocessing.cpu_count()
+    if cpu_limit > 0:
+        trials = min(trials, int(multiprocessing.cpu_count() // cpu_limit))
+    if memory_limit > 0 and available_memory > 0:
+        trials = min(trials,
+                     (available_memory - RESERVED_MEMORY) // memory_limit)
+    return max(1, trials)
+###############################################################################
+
+
+def run_experiment(controller, cpu, ram, sql_script, max_time):
+    """The black box function we want to minimize.
+
+    We give it cpu and ram (our only resources) and it calculates time to run
+    to completion.
+
+    Note: return negative, as the underlying library only supports maximization
+    (so essentially we do minimization).
+    """
+
+    import docker  # pylint: disable=import-outside-toplevel
+
+    # accomodate for the underlying library using only full float numbers
+    cpu = round(cpu, 2)
+    ram = int(ram)
+
+    log.info("Attempting to start container")
+    container = controller.run_container(
+        IMAGE_NAME, IMAGE_VERSION,
+        int(cpu * 10**9),
+        ram,
+        sql_script
+    )
+    log.info("Container started")
+
+    try:
+        # run container until completion or time out
+        log.info(
+            "Running container with CPU limit: %s, RAM limit: %s, SQL script: "
+            "%s, until it completes or %s seconds pass.", cpu,
+            _HumanBytes(ram), sql_script, max_time
+        )
+
+        start = time.time()
+
+        in_time = controller.wait_for_exit(container.name, max_time)
+
+        # return a special, random "too big" value
+        # needs to be random, else the BO process cannot properly explore the
+        # search space
+        if not in_time:
+            total_time = (max_time + random.randint(0,1000)) * -2
+
+            try:
+                controller.kill_container(container)
+            except docker.errors.APIError as exc:
+                log.error("Couldn't kill container %s due to %s. Please "
+                          "manually verify if it is still running after "
+                          "execution completes.", container.name, exc)
+            log.warning("Execution timed out")
+        else:
+            exit_code = controller.container_exit_code(container.name)
+            if exit_code == 0:
+                total_time = time.time() - start
+                log.info("Container execution finished on time")
+            else:
+                # return a special, random "too big" value
+                # needs to be random, else the BO process cannot properly
+                # explore the search space
+                total_time = (max_time + random.randint(0,1000)) * -2
+                log.info("Container execution finished unsuccessfully")
+
+        log.info("Execution logs follow\n")
+        # stream the logs, as they can be large for long running workloads.
+        # Experiments may run concurrently, so each line is labeled with its
+        # container and written in a single call, to not get interleaved.
+        pending = b''
+        for chunk in container.logs(stream=True, timestamps=True,
+                                    follow=False):
+            *lines, pending = (pending + chunk).split(b'\n')
+            for item in lines:
+                sys.stdout.write(
+                    f"    {container.name} | {item.decode('utf-8')}\n")
+        sys.stdout.write(f"    {container.name} | {pending.decode('utf-8')}\n")
+    finally:
+        log.info("Performing pre-exit cleanup")
+        if controller.still_running(container.name):
+            controller.stop_container(container)
+        controller.remove_container(container)
+        log.info("Pre-exit cleanup completed")
+
+    if total_time < 0:
+        return total_time
+    return total_time * -1
+###############################################################################
+
+
+# pylint: disable-next=too-many-arguments
+def run(cpu_limit, memory_limit, time_limit, sql_script, iterations=5,
+        parallel_trials=1):
+    """Run the cost optimization search and return the best values found.
+
+    Same as the command line interface, without its argument parsing and
+    validation, for programmatic use (e.g. parameter sweeps). sql_script must
+    be an absolute path, as it is mounted in the containers.
+
+    parallel_trials experiments may run at once, capped by what the host can
+    fit. Concurrent experiments compete for disk and memory bandwidth, which
+    skews their measured execution time, so the default is one at a time.
+    """
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    import numpy as np
+
+    import docker_controller
+    import bayesian_optimization_engine
+
+    cpu_info = cpuinfo()
+    total_ram, available_ram = meminfo()
+
+    log.info("Initializing...")
+    log.info("Detected CPU: %s", cpu_info)
+    log.info("Total / Available Memory: %s / %s", _HumanBytes(total_ram),
+             _HumanBytes(available_ram))
+
+    vm_controller = docker_controller.DockerController()
+    log.info("Connection to docker daemon established")
+
+    vm_controller.pull(IMAGE_NAME, IMAGE_VERSION)
+    log.info("Image %s:%s is available", IMAGE_NAME, IMAGE_VERSION)
+
+    trials = min(parallel_trials,
+                 max_parallel_trials(cpu_limit, memory_limit, available_ram))
+    if trials > 1:
+        log.info("Running up to %s experiments concurrently", trials)
+
+    bayes_optimizer = bayesian_optimization_engine.BayesianOptimizationEngine(
+        min_cpu=min(cpu_limit, 0.1),             # 10 percent of one cpu
+        max_cpu=cpu_limit,
+        min_ram=min(memory_limit, 60*10**6),     # 60 MB of RAM
+        max_ram=memory_limit,
+        black_box_function = lambda cpu, ram: run_experiment(
+            vm_controller, cpu, ram,sql_script, time_limit),
+        parallel_trials=trials,
+        on_interrupt=vm_controller.kill_all
+    )
+
+    log.info("Starting bayes optimization")
+    start = time.time()
+
+    bayes_optimizer.optimize(
+        initialization_points=3,    # same value as the paper (using the same kernel function, Matern)
+        iterations=iterations
+    )
+
+    log.info("Finished bayes optimization after %s secs", time.time() - start)
+    best = bayes_optimizer.optimizer.max
+    if log.isEnabledFor(logging.INFO):
+        log.info("Best values: CPU: %.2f RAM: %s execution time: %.2f cost: "
+            "%.3f", best['params']['cpu'],
+            _HumanBytes(int(best['params']['ram'])), best['target']*-1,
+            bayes_optimizer.cost(best['params']['cpu'], best['params']['ram'],
+                                 best['target']*-1))
+    if best['target'] <= time_limit*-2:
+        log.warning("No valid parameters found due to the given constraints.")
+
+    # pricing the whole trajectory is only needed for the log
+    if log.isEnabledFor(logging.INFO):
+        results = bayes_optimizer.optimizer.res
+        cpus = np.fromiter((item['params']['cpu'] for item in results),
+                           dtype=np.float64, count=len(results))
+        rams = np.fromiter((item['params']['ram'] for item in results),
+                           dtype=np.float64, count=len(results))
+        exec_times = np.fromiter((item['target'] for item in results),
+                                 dtype=np.float64, count=len(results)) * -1
+        costs = bayes_optimizer.cost(cpus, rams, exec_times)
+
+        # a single log record for the whole report
+        rows = "\n".join(
+            f"Iteration {i}: cpu {cpu:.2f} ram {bytes2human(int(ram))}  "
+            f"exec time: {exec_time:.2f} cost: {cost:.3f}"
+            for i, (cpu, ram, exec_time, cost) in enumerate(
+                zip(cpus, rams, exec_times, costs))
+        )
+        log.info("Full bayesian optimization log:\n%s", rows)
+
+    return best
+###############################################################################